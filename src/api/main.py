@@ -1,21 +1,188 @@
+import asyncio
+import hashlib
+import logging
+import logging.handlers
+import queue
 import mlflow
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from pydantic import BaseModel
 from PIL import Image
-import io
 import numpy as np
 import os
-import json
+import orjson
 import datetime
 import pandas as pd
+from collections import OrderedDict
 from contextlib import asynccontextmanager
-import traceback
 from prometheus_fastapi_instrumentator import Instrumentator  # 6.1: Import Prometheus
 
+# App logging goes through a queue so record formatting (including
+# tracebacks) happens on the listener thread, not the event loop.
+class _PassthroughQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler whose prepare() leaves the record untouched.
+
+    The stdlib prepare() calls self.format(record) on the *emitting*
+    thread (it exists to make records picklable for cross-process
+    queues). Our queue stays in-process, so passing the raw record
+    through defers formatting to the listener thread as well.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+_log_record_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(
+    _log_record_queue, logging.StreamHandler()
+)
+_log_listener.start()
+
+logger = logging.getLogger("taco_sort.api")
+logger.setLevel(logging.INFO)
+logger.addHandler(_PassthroughQueueHandler(_log_record_queue))
+
 # --- Globals ---
 model = None
+raw_model = None  # unwrapped UltralyticsWrapper for the no-DataFrame fast path
+onnx_session = None  # ONNX Runtime session when MODEL_BACKEND=onnx
+onnx_names = None
 PREDICTION_LOG_FILE = "data/logs/prediction_logs.jsonl"  # 6.2: Log file
+CLASS_NAMES_FILE = "taco.yaml"
+ONNX_INPUT_SIZE = 640
+
+# Memoize results for identical uploads (batch replays, flaky clients):
+# a cache hit skips decode, forward pass and NMS entirely.
+PREDICTION_CACHE_SIZE = 1024
+_prediction_cache = OrderedDict()
+
+# 6.2: Prediction logging is buffered through an asyncio queue so the
+# /predict handler never blocks the event loop on disk I/O.
+LOG_QUEUE_MAX = 10_000
+LOG_BATCH_MAX = 256
+log_queue = None
+log_task = None
+_log_fd = None
+
+
+async def _drain_prediction_logs():
+    """Background task: batch queued log lines and append them to disk."""
+    while True:
+        batch = [await log_queue.get()]
+        while len(batch) < LOG_BATCH_MAX:
+            try:
+                batch.append(log_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        await asyncio.to_thread(os.write, _log_fd, b"\n".join(batch) + b"\n")
+
+
+def _flush_remaining_logs():
+    """Synchronously write whatever is still queued (shutdown path)."""
+    batch = []
+    while not log_queue.empty():
+        batch.append(log_queue.get_nowait())
+    if batch:
+        os.write(_log_fd, b"\n".join(batch) + b"\n")
+
+
+# --- ONNX Runtime backend (opt-in via MODEL_BACKEND=onnx) ---
+def _load_onnx_session():
+    """Build an ONNX Runtime session from the artifact in ONNX_MODEL_URI."""
+    import onnxruntime as ort
+    import yaml
+
+    # Prefer a pre-staged local file (see preload_model.py, which drops the
+    # model in /dev/shm so N Uvicorn workers share one page-cache copy of
+    # the weights) over downloading per worker.
+    onnx_path = os.environ.get("ONNX_MODEL_PATH")
+    if onnx_path:
+        print(f"Using pre-staged ONNX model at: {onnx_path}")
+    else:
+        onnx_uri = os.environ["ONNX_MODEL_URI"]
+        print(f"Loading ONNX model from: {onnx_uri}")
+        onnx_path = mlflow.artifacts.download_artifacts(onnx_uri)
+
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = os.cpu_count()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(
+        onnx_path, sess_options=so, providers=["CPUExecutionProvider"]
+    )
+
+    with open(CLASS_NAMES_FILE, "r") as f:
+        names = yaml.safe_load(f)["names"]
+    names_arr = np.asarray([names[i] for i in sorted(names)], dtype=object)
+    return session, names_arr
+
+
+def _predict_onnx(img, conf, iou, orig_size=None):
+    """Run one image through the ONNX session; returns the usual results frame.
+
+    orig_size is the upload's original (width, height) when img was decoded
+    at a reduced scale (see _decode_upload); boxes are returned in that space.
+    """
+    import torch
+    from ultralytics.utils import ops
+
+    out_w, out_h = orig_size if orig_size is not None else img.size
+
+    # Letterbox to the 640x640 model input (resize preserving aspect ratio,
+    # pad the rest with Ultralytics' gray) instead of squashing to square,
+    # so this backend sees the same geometry the pyfunc pipeline feeds the
+    # model and returns equivalent detections.
+    rgb = img.convert("RGB")
+    scale = ONNX_INPUT_SIZE / max(rgb.size)
+    new_w, new_h = round(rgb.width * scale), round(rgb.height * scale)
+    canvas = Image.new("RGB", (ONNX_INPUT_SIZE, ONNX_INPUT_SIZE), (114, 114, 114))
+    canvas.paste(
+        rgb.resize((new_w, new_h)),
+        ((ONNX_INPUT_SIZE - new_w) // 2, (ONNX_INPUT_SIZE - new_h) // 2),
+    )
+    arr = np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1)[None] / 255.0
+
+    (output,) = onnx_session.run(None, {onnx_session.get_inputs()[0].name: arr})
+    preds = ops.non_max_suppression(
+        torch.from_numpy(output), conf_thres=conf, iou_thres=iou
+    )[0]
+    # Undo the letterbox scale/padding straight into the upload's original
+    # pixel space (draft preserves aspect ratio, so the pad offsets match).
+    preds[:, :4] = ops.scale_boxes(
+        (ONNX_INPUT_SIZE, ONNX_INPUT_SIZE), preds[:, :4], (out_h, out_w)
+    )
+    preds = preds.numpy()
+
+    results_df = pd.DataFrame(
+        preds, columns=["xmin", "ymin", "xmax", "ymax", "confidence", "class_id"]
+    )
+    results_df["name"] = onnx_names[results_df["class_id"].to_numpy().astype(np.int64)]
+    return results_df[["xmin", "ymin", "xmax", "ymax", "confidence", "name"]]
+
+
+def _hash_upload(fileobj) -> bytes:
+    """Digest the spooled upload in 64KiB chunks (runs in a worker thread)."""
+    fileobj.seek(0)
+    h = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: fileobj.read(64 * 1024), b""):
+        h.update(chunk)
+    return h.digest()
+
+
+def _decode_upload(fileobj) -> tuple[Image.Image, tuple[int, int]]:
+    """Decode an uploaded image (runs in a worker thread, off the event loop).
+
+    Returns the decoded image together with the upload's original
+    (width, height): draft() may decode large JPEGs at a reduced DCT scale,
+    so boxes predicted on the decoded image must be scaled back to the
+    original coordinate space before they are returned to the client.
+    """
+    fileobj.seek(0)
+    img = Image.open(fileobj)
+    orig_size = img.size
+    # For JPEGs, ask libjpeg to decode at the nearest DCT scale above the
+    # model input size instead of full resolution; no-op for other formats.
+    img.draft("RGB", (ONNX_INPUT_SIZE, ONNX_INPUT_SIZE))
+    return img.convert("RGB"), orig_size
 
 
 # --- Pydantic Models ---
@@ -35,25 +202,67 @@ class PredictionResponse(BaseModel):
 # --- Lifespan Event ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model
+    global model, raw_model, onnx_session, onnx_names, log_queue, log_task, _log_fd
 
-    # 6.2: Create logs directory on startup
+    # 6.2: Create logs directory and start the log writer on startup
     os.makedirs(os.path.dirname(PREDICTION_LOG_FILE), exist_ok=True)
+    _log_fd = os.open(PREDICTION_LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    log_queue = asyncio.Queue(maxsize=LOG_QUEUE_MAX)
+    log_task = asyncio.create_task(_drain_prediction_logs())
 
     tracking_uri = os.environ.get("MLFLOW_TRACKING_URI", "http://127.0.0.1:5000")
     print(f"Setting MLflow tracking URI to: {tracking_uri}")
     mlflow.set_tracking_uri(tracking_uri)
 
-    model_uri = "models:/taco_sort_yolo@staging"
-    print(f"Loading model from: {model_uri}")
+    if os.environ.get("MODEL_BACKEND") == "onnx":
+        # Serve the exported ONNX artifact directly through ONNX Runtime:
+        # no pyfunc hop, no per-op Python dispatch.
+        onnx_session, onnx_names = _load_onnx_session()
+        print("ONNX Runtime session created successfully.")
+    else:
+        model_uri = "models:/taco_sort_yolo@staging"
+        print(f"Loading model from: {model_uri}")
+
+        model = mlflow.pyfunc.load_model(model_uri)
+        print("Model loaded successfully from Registry.")
+
+        # Grab the underlying UltralyticsWrapper so /predict can pass the PIL
+        # image straight through instead of building a one-row DataFrame.
+        raw_model = getattr(model._model_impl, "python_model", None)
 
-    model = mlflow.pyfunc.load_model(model_uri)
-    print("Model loaded successfully from Registry.")
+        try:
+            import torch
+
+            torch.set_num_threads(os.cpu_count())
+        except ImportError:
+            pass
+
+    # Warm up with one dummy image so the first real request doesn't pay
+    # lazy device/context initialization and kernel JIT on the event loop.
+    dummy = Image.new("RGB", (ONNX_INPUT_SIZE, ONNX_INPUT_SIZE))
+    if onnx_session is not None:
+        _predict_onnx(dummy, 0.25, 0.7)
+    elif raw_model is not None:
+        raw_model.predict(None, [dummy], params={"conf": 0.25, "iou": 0.7})
+    else:
+        model.predict(
+            pd.DataFrame([dummy], columns=["image"]), params={"conf": 0.25, "iou": 0.7}
+        )
+    print("Warmup prediction complete.")
 
     yield
 
     print("Cleaning up and shutting down...")
+    log_task.cancel()
+    try:
+        await log_task
+    except asyncio.CancelledError:
+        pass
+    _flush_remaining_logs()
+    os.close(_log_fd)
     model = None
+    raw_model = None
+    onnx_session = None
 
 
 # --- App Creation ---
@@ -66,7 +275,7 @@ Instrumentator().instrument(app).expose(app)
 # --- API Endpoints ---
 @app.get("/health")
 def health_check():
-    if model:
+    if model or onnx_session:
         return {"status": "ok", "model_loaded": True}
     return {"status": "error", "model_loaded": False}
 
@@ -78,47 +287,92 @@ async def predict(
     iou: float = Query(0.7, ge=0.0, le=1.0, description="IoU threshold for NMS"),
 ):
     try:
-        image_bytes = await image.read()
-        img = Image.open(io.BytesIO(image_bytes))
+        # Work straight off the SpooledTemporaryFile behind the upload:
+        # hashing and decoding read it in chunks, so the body is never
+        # materialized as one large bytes object.
+        # Cache key: content hash of the upload plus the thresholds, so a
+        # parameter change bypasses stale entries.
+        digest = await asyncio.to_thread(_hash_upload, image.file)
+        cache_key = (digest, conf, iou)
+        results_df = _prediction_cache.get(cache_key)
 
-        input_df = pd.DataFrame([img], columns=["image"])
-        runtime_params = {"conf": conf, "iou": iou}
+        if results_df is not None:
+            _prediction_cache.move_to_end(cache_key)
+        else:
+            # PIL's decoder is pure CPU and would block other requests if
+            # run on the event loop thread.
+            img, orig_size = await asyncio.to_thread(_decode_upload, image.file)
 
-        results_df = model.predict(input_df, params=runtime_params)
+            runtime_params = {"conf": conf, "iou": iou}
+
+            if onnx_session is not None:
+                results_df = _predict_onnx(img, conf, iou, orig_size)
+            else:
+                if raw_model is not None:
+                    # In-process fast path: skip the pyfunc DataFrame marshalling.
+                    results_df = raw_model.predict(None, [img], params=runtime_params)
+                else:
+                    input_df = pd.DataFrame([img], columns=["image"])
+                    results_df = model.predict(input_df, params=runtime_params)
+                if img.size != orig_size:
+                    # draft() decoded the JPEG below the uploaded resolution;
+                    # map the boxes back to the original pixel space.
+                    results_df[["xmin", "xmax"]] *= orig_size[0] / img.width
+                    results_df[["ymin", "ymax"]] *= orig_size[1] / img.height
+
+            _prediction_cache[cache_key] = results_df
+            if len(_prediction_cache) > PREDICTION_CACHE_SIZE:
+                _prediction_cache.popitem(last=False)
 
         # 6.2: Log proxy metrics for this prediction
         try:
+            confidences = results_df["confidence"].to_numpy(
+                dtype=np.float32, copy=False
+            )
             log_entry = {
-                "timestamp": datetime.datetime.now().isoformat(),
-                "num_boxes_predicted": len(results_df),
-                "avg_confidence": np.nan_to_num(results_df["confidence"].mean()),
-                "class_distribution": results_df["name"].value_counts().to_dict(),
+                "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "num_boxes_predicted": int(confidences.size),
+                "avg_confidence": float(confidences.mean()) if confidences.size else 0.0,
             }
-            with open(PREDICTION_LOG_FILE, "a") as f:
-                f.write(json.dumps(log_entry) + "\n")
+            # Log class counts pre-flattened (one class_<name> key each) so
+            # monitor_drift.py reads straight into its final column shape.
+            uniq, counts = np.unique(results_df["name"].to_numpy(), return_counts=True)
+            log_entry.update({f"class_{k}": v for k, v in zip(uniq, counts)})
+            # Serialize once here (orjson handles the numpy scalars) so the
+            # writer task only has to join bytes.
+            log_queue.put_nowait(
+                orjson.dumps(log_entry, option=orjson.OPT_SERIALIZE_NUMPY)
+            )
+        except asyncio.QueueFull:
+            pass  # drop rather than stall the request path under load
         except Exception as log_e:
             print(f"WARNING: Failed to log prediction: {log_e}")
 
-        # Convert to API response
-        response_boxes = []
-        for _, row in results_df.iterrows():
-            response_boxes.append(
-                BBox(
-                    x1=row["xmin"],
-                    y1=row["ymin"],
-                    x2=row["xmax"],
-                    y2=row["ymax"],
-                    confidence=row["confidence"],
-                    class_name=row["name"],
-                )
+        # Convert to API response. Pull each column out as a NumPy array
+        # once instead of iterrows(), which builds a Series per row.
+        xmin = results_df["xmin"].to_numpy()
+        ymin = results_df["ymin"].to_numpy()
+        xmax = results_df["xmax"].to_numpy()
+        ymax = results_df["ymax"].to_numpy()
+        confidence = results_df["confidence"].to_numpy()
+        names = results_df["name"].to_numpy()
+
+        response_boxes = [
+            BBox(
+                x1=float(xmin[i]),
+                y1=float(ymin[i]),
+                x2=float(xmax[i]),
+                y2=float(ymax[i]),
+                confidence=float(confidence[i]),
+                class_name=names[i],
             )
+            for i in range(len(results_df))
+        ]
 
         return {"boxes": response_boxes}
 
     except Exception as e:
-        print("--- PREDICTION FAILED ---")
-        print(traceback.format_exc())
-        print("-------------------------")
+        logger.exception("Prediction failed")
         raise HTTPException(
             status_code=500,
             detail=f"Internal Server Error: {str(e)}. Check server logs for full traceback.",
@@ -0,0 +1,30 @@
+import mlflow
+import os
+import shutil
+
+# --- Config ---
+SHM_MODEL_PATH = "/dev/shm/taco_sort.onnx"
+
+
+def main():
+    """Stage the ONNX model in shared memory before starting Uvicorn workers.
+
+    With `uvicorn --workers N`, each worker that downloads its own copy of
+    the model holds its own weights in memory. Staging the file once in
+    /dev/shm lets every worker's InferenceSession read the same page-cache
+    copy: run this script first, then start workers with
+    MODEL_BACKEND=onnx ONNX_MODEL_PATH=/dev/shm/taco_sort.onnx.
+    """
+    tracking_uri = os.environ.get("MLFLOW_TRACKING_URI", "http://127.0.0.1:5000")
+    mlflow.set_tracking_uri(tracking_uri)
+
+    onnx_uri = os.environ["ONNX_MODEL_URI"]
+    print(f"Downloading ONNX model from: {onnx_uri}")
+    local_path = mlflow.artifacts.download_artifacts(onnx_uri)
+
+    shutil.copy(local_path, SHM_MODEL_PATH)
+    print(f"Model staged at {SHM_MODEL_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,80 @@
 import mlflow
-import pandas as pd
 import numpy as np
-import glob
+import pandas as pd
 import os
-import json
+import orjson
 import time
-from PIL import Image
 
 # --- Config ---
 MLFLOW_URI = "http://127.0.0.1:5001"
 MODEL_URI = "models:/taco_sort_yolo@production"
 VAL_IMAGES_PATH = "data/prepared/images/val/"
 OUTPUT_LOG_PATH = "data/reference_data.jsonl"  # Use .jsonl for logs
+OUTPUT_STATS_PATH = "data/reference_data.npz"  # NumPy sidecar for monitor_drift
+BATCH_SIZE = 32
 
 
 def main():
     print(f"Loading reference model from: {MODEL_URI}")
     mlflow.set_tracking_uri(MLFLOW_URI)
-    model = mlflow.pyfunc.load_model(MODEL_URI)
+    loaded = mlflow.pyfunc.load_model(MODEL_URI)
+
+    # Bypass the pyfunc DataFrame layer for this offline script: hand the
+    # whole directory to Ultralytics so it runs its own dataloader with
+    # parallel image decode and batched forward passes.
+    yolo = loaded._model_impl.python_model.model
+    names_arr = np.asarray([yolo.names[i] for i in sorted(yolo.names)], dtype=object)
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(OUTPUT_LOG_PATH), exist_ok=True)
 
-    # Find all validation images
-    image_files = glob.glob(os.path.join(VAL_IMAGES_PATH, "*.jpg"))
-    print(f"Found {len(image_files)} validation images.")
-
-    with open(OUTPUT_LOG_PATH, "w") as f:
-        for img_path in image_files:
-            try:
-                img = Image.open(img_path)
-
-                # Create the DataFrame input for the pyfunc model
-                input_df = pd.DataFrame([img], columns=["image"])
-
-                # Make prediction
-                df = model.predict(input_df)
-
-                # --- THIS IS THE FIX ---
-                # We must explicitly convert all numpy types to native Python types
-                # for JSON serialization.
-
-                num_boxes = int(len(df))  # Cast numpy.int64 to int
-
-                if num_boxes > 0:
-                    # FIX 1: Use .item() to convert numpy.float32 to python float
-                    avg_confidence = np.mean(df["confidence"].values).item()
-
-                    # FIX 2: Explicitly cast values in the dict to python int
-                    class_counts = df["name"].value_counts()
-                    class_distribution = {
-                        str(k): int(v) for k, v in class_counts.items()
-                    }
-                else:
-                    avg_confidence = 0.0
-                    class_distribution = {}
-
-                # Create the log entry
-                entry = {
-                    "timestamp": time.time(),
-                    "num_boxes_predicted": num_boxes,
-                    "avg_confidence": avg_confidence,
-                    "class_distribution": class_distribution,
-                }
-
-                # Write the log line
-                f.write(json.dumps(entry) + "\n")
-
-            except Exception as e:
-                print(f"Failed to process {img_path}: {e}")
-
-    print(f"Saving reference data to {OUTPUT_LOG_PATH}...")
+    processed = 0
+    entries = []
+    # Binary mode with a large buffer: one flush per 64KiB instead of
+    # text-mode line buffering; orjson handles the numpy scalars natively.
+    with open(OUTPUT_LOG_PATH, "wb", buffering=64 * 1024) as f:
+        results = yolo.predict(
+            source=VAL_IMAGES_PATH,
+            stream=True,
+            batch=BATCH_SIZE,
+            conf=0.25,
+            iou=0.7,
+        )
+        for res in results:
+            # One extraction per image: (N, 6) array of boxes
+            boxes = res.boxes.data.cpu().numpy()
+            num_boxes = int(boxes.shape[0])
+
+            avg_confidence = boxes[:, 4].mean() if num_boxes > 0 else 0.0
+
+            # Create the log entry, with class counts pre-flattened into
+            # class_<name> keys to match the API's prediction logs.
+            entry = {
+                "timestamp": time.time(),
+                "num_boxes_predicted": num_boxes,
+                "avg_confidence": avg_confidence,
+            }
+            if num_boxes > 0:
+                class_ids, counts = np.unique(
+                    boxes[:, 5].astype(int), return_counts=True
+                )
+                entry.update(
+                    {f"class_{k}": v for k, v in zip(names_arr[class_ids], counts)}
+                )
+
+            # Write the log line
+            f.write(orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY))
+            f.write(b"\n")
+            entries.append(entry)
+            processed += 1
+
+    print(f"Saved reference data for {processed} images to {OUTPUT_LOG_PATH}.")
+
+    # Dump the same columns as an .npz sidecar so monitor_drift.py can
+    # mmap the reference stats instead of re-parsing JSONL every run.
+    stats_df = pd.DataFrame(entries).fillna(0)
+    np.savez(OUTPUT_STATS_PATH, **{col: stats_df[col].to_numpy() for col in stats_df})
+    print(f"Saved reference stats sidecar to {OUTPUT_STATS_PATH}.")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from evidently.report import Report
 
@@ -18,7 +19,7 @@ def load_and_normalize(ref_path, cur_path):
     robust way to compare them.
     """
     try:
-        ref_df = pd.read_json(ref_path, lines=True)
+        ref_df = _load_reference(ref_path)
         cur_df = pd.read_json(cur_path, lines=True)
     except FileNotFoundError as e:
         print(f"Error: {e}")
@@ -30,26 +31,44 @@ def load_and_normalize(ref_path, cur_path):
     if ref_df.empty or cur_df.empty:
         return ref_df, cur_df
 
-    # Flatten the nested JSON into columns
-    ref_flat = pd.json_normalize(ref_df["class_distribution"]).add_prefix("class_")
-    cur_flat = pd.json_normalize(cur_df["class_distribution"]).add_prefix("class_")
-
-    # Combine with main DFs
-    ref_df = pd.concat([ref_df.drop("class_distribution", axis=1), ref_flat], axis=1)
-    cur_df = pd.concat([cur_df.drop("class_distribution", axis=1), cur_flat], axis=1)
+    # The loggers now write class counts pre-flattened as class_<name>
+    # columns, so no json_normalize pass is needed. Keep a fallback for
+    # logs written before the schema change.
+    ref_df = _flatten_legacy(ref_df)
+    cur_df = _flatten_legacy(cur_df)
 
     # --- Robust Column Normalization Logic ---
-    # Find all unique columns from both dataframes
-    all_cols = set(ref_df.columns).union(set(cur_df.columns))
-
-    # Re-index both dataframes to have the same columns, filling missing with 0
+    # Align both dataframes on the union of their columns (vectorized
+    # Index union), filling missing class counts with 0.
     # This prevents errors and false negatives during drift detection.
+    all_cols = ref_df.columns.union(cur_df.columns)
     ref_df = ref_df.reindex(columns=all_cols, fill_value=0)
     cur_df = cur_df.reindex(columns=all_cols, fill_value=0)
 
     return ref_df, cur_df
 
 
+def _load_reference(ref_path):
+    """Load reference stats, preferring the .npz sidecar over JSONL parsing.
+
+    generate_reference.py writes the already-flattened columns to an .npz
+    next to the JSONL; mmap-loading that skips the line-by-line JSON parse.
+    """
+    npz_path = os.path.splitext(ref_path)[0] + ".npz"
+    if os.path.exists(npz_path):
+        npz = np.load(npz_path, mmap_mode="r", allow_pickle=True)
+        return pd.DataFrame({k: npz[k] for k in npz.files})
+    return pd.read_json(ref_path, lines=True)
+
+
+def _flatten_legacy(df):
+    """Flatten a nested class_distribution column from pre-flattening logs."""
+    if "class_distribution" not in df.columns:
+        return df
+    flat = pd.json_normalize(df["class_distribution"]).add_prefix("class_")
+    return pd.concat([df.drop("class_distribution", axis=1), flat], axis=1)
+
+
 def main():
     print("Starting drift monitoring...")
 
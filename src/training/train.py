@@ -1,8 +1,11 @@
 import mlflow
 import mlflow.pyfunc
 from ultralytics import YOLO
+from onnxruntime.quantization import QuantType, quantize_static
 from pathlib import Path
+import numpy as np
 import pandas as pd
+from PIL import Image
 
 
 # --- Custom MLflow Wrapper ---
@@ -10,6 +13,11 @@ class UltralyticsWrapper(mlflow.pyfunc.PythonModel):
     def load_context(self, context):
         model_path = context.artifacts["model_path"]
         self.model = YOLO(model_path)
+        # Cache class names as an object array so predict() can map
+        # class ids to names with a single NumPy gather.
+        self._names_arr = np.asarray(
+            [self.model.names[i] for i in sorted(self.model.names)], dtype=object
+        )
         print("Custom UltralyticsWrapper loaded successfully.")
 
     def predict(self, context, model_input, params=None):
@@ -20,17 +28,53 @@ class UltralyticsWrapper(mlflow.pyfunc.PythonModel):
             conf = params.get("conf", 0.25)
             iou = params.get("iou", 0.7)
 
-        all_boxes = []
-        for i, row in model_input.iterrows():
-            img = row.iloc[0]
-            results = self.model.predict(img, conf=conf, iou=iou)
-            boxes = results[0].boxes.data
+        # Fast path: in-process callers can hand us a PIL image (or a list
+        # of them) directly and skip the DataFrame round-trip entirely.
+        if isinstance(model_input, Image.Image):
+            imgs = [model_input]
+        elif isinstance(model_input, list):
+            imgs = model_input
+        else:
+            # Run the whole batch in ONE forward pass instead of calling
+            # the model once per row (which also only ever processed row 0).
+            imgs = list(model_input.iloc[:, 0])
+        if not imgs:
+            return pd.DataFrame(
+                columns=["image_idx", "xmin", "ymin", "xmax", "ymax", "confidence", "name"]
+            )
+
+        results = self.model.predict(imgs, conf=conf, iou=iou)
+
+        dfs = []
+        for i, result in enumerate(results):
             df = pd.DataFrame(
-                boxes.cpu().numpy(),
+                result.boxes.data.cpu().numpy(),
                 columns=["xmin", "ymin", "xmax", "ymax", "confidence", "class_id"],
             )
-            df["name"] = df["class_id"].apply(lambda x: self.model.names[int(x)])
-            return df[["xmin", "ymin", "xmax", "ymax", "confidence", "name"]]
+            df["image_idx"] = i
+            dfs.append(df)
+
+        out = pd.concat(dfs, ignore_index=True)
+        out["name"] = self._names_arr[out["class_id"].to_numpy().astype(np.int64)]
+        return out[["image_idx", "xmin", "ymin", "xmax", "ymax", "confidence", "name"]]
+
+
+class YoloCalibrationReader:
+    """Feeds normalized validation images to ONNX Runtime static quantization."""
+
+    def __init__(self, image_dir, input_name, imgsz, limit=100):
+        self.paths = sorted(Path(image_dir).glob("*.jpg"))[:limit]
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self._iter = iter(self.paths)
+
+    def get_next(self):
+        path = next(self._iter, None)
+        if path is None:
+            return None
+        img = Image.open(path).convert("RGB").resize((self.imgsz, self.imgsz))
+        arr = np.asarray(img, dtype=np.float32).transpose(2, 0, 1)[None] / 255.0
+        return {self.input_name: arr}
 
 
 # Connect to MLflow
@@ -92,6 +136,23 @@ with mlflow.start_run() as run:
     mlflow.log_artifact(str(Path(results.save_dir) / "results.png"))
     mlflow.log_artifact(str(Path(results.save_dir) / "confusion_matrix.png"))
 
+    # Export an ONNX copy so the API can serve through ONNX Runtime
+    # (set MODEL_BACKEND=onnx) without the pyfunc/pandas layer.
+    onnx_path = YOLO(str(best_model_path)).export(format="onnx")
+    mlflow.log_artifact(str(onnx_path), artifact_path="onnx")
+
+    # Also log an INT8-quantized copy: halves weight bandwidth and uses the
+    # VNNI/AMX integer paths on CPU serving. Point ONNX_MODEL_URI at the
+    # onnx-int8 artifact to serve it.
+    int8_path = str(Path(onnx_path).with_suffix(".int8.onnx"))
+    calibration_reader = YoloCalibrationReader(
+        "data/prepared/images/val", "images", params["imgsz"]
+    )
+    quantize_static(
+        str(onnx_path), int8_path, calibration_reader, weight_type=QuantType.QInt8
+    )
+    mlflow.log_artifact(int8_path, artifact_path="onnx-int8")
+
     # Log model
     artifacts = {"model_path": str(best_model_path)}
     mlflow.pyfunc.log_model(
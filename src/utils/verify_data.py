@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 import os
 import random
 import yaml
@@ -16,32 +17,26 @@ NUM_IMAGES_TO_CHECK = 5
 # ---------------------
 
 
-def yolo_to_pixel_bbox(yolo_bbox, img_w, img_h):
+def yolo_to_pixel_bbox(yolo_bboxes, img_w, img_h):
     """
-    Converts a normalized YOLO format [x_center, y_center, w, h]
-    to pixel coordinates [x_min, y_min, x_max, y_max].
+    Converts normalized YOLO boxes [x_center, y_center, w, h] (Nx4)
+    to pixel coordinates [x_min, y_min, x_max, y_max] (Nx4, int),
+    clamped to the image boundaries. Vectorized over all boxes.
     """
-    x_center_norm, y_center_norm, w_norm, h_norm = yolo_bbox
-
     # De-normalize
-    x_center_pix = x_center_norm * img_w
-    y_center_pix = y_center_norm * img_h
-    w_pix = w_norm * img_w
-    h_pix = h_norm * img_h
+    centers = yolo_bboxes[:, :2] * (img_w, img_h)
+    half_sizes = yolo_bboxes[:, 2:] * (img_w, img_h) / 2
 
     # Calculate pixel coordinates
-    x_min = int(x_center_pix - (w_pix / 2))
-    y_min = int(y_center_pix - (h_pix / 2))
-    x_max = int(x_center_pix + (w_pix / 2))
-    y_max = int(y_center_pix + (h_pix / 2))
+    mins = (centers - half_sizes).astype(int)
+    maxs = (centers + half_sizes).astype(int)
 
     # Clamp values to image boundaries
-    x_min = max(0, x_min)
-    y_min = max(0, y_min)
-    x_max = min(img_w - 1, x_max)
-    y_max = min(img_h - 1, y_max)
+    bounds = np.array([img_w - 1, img_h - 1])
+    mins = np.clip(mins, 0, bounds)
+    maxs = np.clip(maxs, 0, bounds)
 
-    return x_min, y_min, x_max, y_max
+    return np.hstack([mins, maxs])
 
 
 def main():
@@ -60,16 +55,26 @@ def main():
         print(f"Error: Could not read {YAML_FILE}. {e}")
         return
 
-    # 3. Get list of all validation images
-    image_files = list(IMAGE_DIR.glob("*.jpg"))
-    if not image_files:
+    # 3+4. Reservoir-sample random images directly while scanning the
+    # directory, instead of materializing every path just to pick a few
+    selected_images = []
+    seen = 0
+    with os.scandir(IMAGE_DIR) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".jpg"):
+                continue
+            seen += 1
+            if len(selected_images) < NUM_IMAGES_TO_CHECK:
+                selected_images.append(Path(entry.path))
+            else:
+                j = random.randrange(seen)
+                if j < NUM_IMAGES_TO_CHECK:
+                    selected_images[j] = Path(entry.path)
+
+    if not selected_images:
         print(f"Error: No images found in {IMAGE_DIR}")
         return
 
-    # 4. Pick random images
-    selected_images = random.sample(
-        image_files, min(NUM_IMAGES_TO_CHECK, len(image_files))
-    )
     print(f"Randomly selected {len(selected_images)} images to verify...")
 
     # 5. Process each selected image
@@ -90,29 +95,28 @@ def main():
 
         if not label_path.exists():
             print("  - Warning: No label file found. Saving blank image.")
+        elif label_path.stat().st_size == 0:
+            print("  - Info: Label file is empty (no objects).")
         else:
-            with open(label_path, "r") as f:
-                lines = f.readlines()
-
-            if not lines:
-                print("  - Info: Label file is empty (no objects).")
-
-            # Draw each bounding box
-            for line in lines:
-                parts = line.strip().split()
-                if len(parts) != 5:
-                    print(f"  - Warning: Skipping malformed line: {line.strip()}")
-                    continue
-
-                try:
-                    class_id = int(parts[0])
-                    yolo_bbox = [float(p) for p in parts[1:]]
-
-                    # Convert coords
-                    x_min, y_min, x_max, y_max = yolo_to_pixel_bbox(
-                        yolo_bbox, img_w, img_h
-                    )
-
+            # Parse the whole file in one np.loadtxt call instead of
+            # splitting and float()-converting each line in Python
+            try:
+                arr = np.loadtxt(label_path, ndmin=2)
+            except ValueError as e:
+                print(f"  - Error parsing {label_path.name}: {e}")
+                arr = np.empty((0, 5))
+
+            if arr.size and arr.shape[1] != 5:
+                print(f"  - Warning: Expected 5 columns, got {arr.shape[1]}. Skipping.")
+            elif arr.size:
+                # Convert every box in one vectorized call
+                class_ids = arr[:, 0].astype(int).tolist()
+                pixel_boxes = yolo_to_pixel_bbox(arr[:, 1:], img_w, img_h).tolist()
+
+                # Draw each bounding box
+                for class_id, (x_min, y_min, x_max, y_max) in zip(
+                    class_ids, pixel_boxes
+                ):
                     # Get class name
                     class_name = class_names.get(class_id, f"ID:{class_id}")
 
@@ -132,9 +136,6 @@ def main():
                         f"  - Found: {class_name} at [{x_min}, {y_min}, {x_max}, {y_max}]"
                     )
 
-                except Exception as e:
-                    print(f"  - Error processing line '{line.strip()}': {e}")
-
         # 6. Save the new image
         output_path = OUTPUT_DIR / f"VERIFIED_{img_path.name}"
         cv2.imwrite(str(output_path), img)